@@ -1,20 +1,25 @@
+import asyncio
 import logging
 import secrets
 import traceback
-from datetime import timedelta
+from collections import defaultdict
 from itertools import count
-from math import ceil
 import hashlib
+import hmac
 from os import getenv
 from pathlib import Path
 
 import fastapi
+import numpy as np
+from numba import njit
 
 logger = logging.getLogger("app")
 
 from fastapi import FastAPI, HTTPException, Query, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import or_
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import and_, case, cast, not_, or_
+from sqlalchemy.orm import selectinload
 from db import *
 import datetime
 from typing import List, Dict, Optional
@@ -25,7 +30,12 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
-active_tokens = set()
+# Auth tokens are kept in Redis, so they survive restarts and are shared between workers
+TOKEN_TTL = 86400
+# Salted PBKDF2-HMAC-SHA256 of the password, both hex encoded
+PASSWORD_SALT = bytes.fromhex(getenv("PASSWORD_SALT", ""))
+PASSWORD_HASH = bytes.fromhex(getenv("PASSWORD_HASH", ""))
+PBKDF2_ITERATIONS = 600_000
 
 # Pydantic Models (matching TypeScript interfaces)
 class AliasModel(BaseModel):
@@ -55,7 +65,7 @@ class TimeSlotData(BaseModel):
 
 
 # FastAPI app initialization
-app = FastAPI(title="User Activity API", version="1.0.0")
+app = FastAPI(title="User Activity API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -68,68 +78,58 @@ app.add_middleware(
 
 
 async def require_auth(x_auth: str = Header(None)):
-    if x_auth not in active_tokens:
+    if x_auth is None or not await redis_client.exists(f"tok:{x_auth}"):
         raise HTTPException(401, "not authorized")
 
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-
-# Helper functions
-def get_user_channels(db, user_handle: str) -> List[str]:
-    """Get unique channels a user has been in"""
-    result = db.query(Channel.name).distinct().join(
-        Event, or_(Event.prevChannel == Channel.id, Event.nextChannel == Channel.id)
-    ).filter(Event.user_ == user_handle).all()
-    return [r[0] for r in result]
-
-
-def get_last_seen(db, user_handle: str) -> Optional[datetime.datetime]:
-    """Get the last event timestamp for a user"""
-    result = db.query(func.max(Event.timestamp)).filter(Event.user_ == user_handle).scalar()
-    return result
-
-
-def get_total_events(db, user_handle: str) -> int:
-    """Get total number of events for a user"""
-    return db.query(func.count(Event.id)).filter(Event.user_ == user_handle).scalar()
 
 
 # API Endpoints
 @app.get("/api/users", response_model=List[UserModel])
-async def get_users(auth=fastapi.Depends(require_auth)):
-    db = next(get_db())
+async def get_users(auth=fastapi.Depends(require_auth), db: AsyncSession = fastapi.Depends(get_db)):
     try:
         try:
-            users = db.query(User).all()
+            users = (await db.scalars(select(User).options(selectinload(User.aliases)))).all()
         except Exception as e:
-            rollback()
+            await db.rollback()
             e.add_note("Rolled back")
             raise e
 
+        # Last seen and event count for every user in one grouped query
+        stats = {
+            handle: (last_seen, total_events)
+            for handle, last_seen, total_events in await db.execute(
+                select(Event.user_, func.max(Event.timestamp), func.count(Event.id)).group_by(Event.user_)
+            )
+        }
+
+        # Unique channels every user has been in
+        channels = defaultdict(list)
+        for handle, name in await db.execute(
+            select(Event.user_, Channel.name).distinct().join(
+                Channel, or_(Event.prevChannel == Channel.id, Event.nextChannel == Channel.id)
+            )
+        ):
+            channels[handle].append(name)
+
         user_models = []
 
         for user in users:
-            aliases = [AliasModel(name=alias.name) for alias in user.aliases]
-            channels = get_user_channels(db, user.handle)
-            last_seen = get_last_seen(db, user.handle)
-            total_events = get_total_events(db, user.handle)
+            last_seen, total_events = stats.get(user.handle, (None, 0))
 
             user_model = UserModel(
                 id=user.handle,
                 handle=user.handle,
                 pfp=user.pfp,
                 isBot=user.is_bot,
-                aliases=aliases,
+                aliases=[AliasModel(name=alias.name) for alias in user.aliases],
                 lastSeen=last_seen,
                 totalEvents=total_events,
-                channels=channels
+                channels=channels[user.handle]
             )
             user_models.append(user_model)
 
@@ -137,13 +137,15 @@ async def get_users(auth=fastapi.Depends(require_auth)):
     except Exception:
         logger.exception("Unhandled error")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        db.close()
 
 
 @app.get("/api/activity/{year}/{month}", response_model=ActivityData)
-async def get_activity_data_for_month(year: int, month: int, auth=fastapi.Depends(require_auth)):
-    db = next(get_db())
+async def get_activity_data_for_month(
+    year: int,
+    month: int,
+    auth=fastapi.Depends(require_auth),
+    db: AsyncSession = fastapi.Depends(get_db)
+):
     try:
         # Validate month/year
         if not (1 <= month <= 12):
@@ -163,57 +165,55 @@ async def get_activity_data_for_month(year: int, month: int, auth=fastapi.Depend
             dates.append(current_date)
             current_date += datetime.timedelta(days=1)
 
-        # Get all users
-        try:
-            users = db.query(User).all()
-        except Exception as e:
-            rollback()
-            e.add_note("Rolled back")
-            raise e
-
-        user_handles = [user.handle for user in users]
-        active = set()
-
-        # Build result dictionary
+        # Days each user had any events on, in one grouped query
+        day = func.date(Event.timestamp).label("d")
+        active = defaultdict(set)
+        for handle, date in await db.execute(
+            select(Event.user_, day).where(
+                Event.user_.is_not(None),
+                Event.timestamp >= start_date,
+                Event.timestamp < end_date
+            ).group_by(Event.user_, day)
+        ):
+            active[handle].add(date)
+
+        # Build result dictionary, only users active during the month are included
         result = {}
         for date in dates:
-            date_str = date.isoformat()
-            result[date_str] = {}
-
-            # For each user, check if they had any events on this date
-            for handle in user_handles:
-                event_count = db.query(func.count(Event.id)).filter(
-                    Event.user_ == handle,
-                    func.date(Event.timestamp) == date
-                ).scalar()
-                if event_count > 0:
-                    active.add(handle)
-                result[date_str][handle] = event_count > 0
-        inactive = set(user_handles) - active
-        for date in dates:
-            date_str = date.isoformat()
-            for name in inactive:
-                result[date_str].pop(name)
+            result[date.isoformat()] = {handle: date in days for handle, days in active.items()}
         return result
     except HTTPException:
         raise
     except Exception:
         logger.exception("Unhandled error")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        db.close()
 
 
+# (time label, hour, minute) of each 10-minute slot of the day
+BUCKET_META = [(f"{i//6:02d}:{(i%6)*10:02d}", i // 6, (i % 6) * 10) for i in range(144)]
 
-def floor_to_10_minutes(dt: datetime) -> datetime:
-    return dt.replace(minute=(dt.minute // 10) * 10, second=0, microsecond=0)
 
+# Explicit signature compiles at import, not inside the first request on the shared event loop
+@njit("UniTuple(int64[:], 3)(int64[:], int64[:], int64, int64)", cache=True)
+def sweep(buckets: np.ndarray, deltas: np.ndarray, first_bucket: int, n_buckets: int):
+    """Run the active user total over sorted buckets and fold it into per-slot sum, peak and sample count"""
+    sums = np.zeros(144, dtype=np.int64)
+    peaks = np.zeros(144, dtype=np.int64)
+    counts = np.zeros(144, dtype=np.int64)
+    active_users = 0
+    event_i = 0
 
-def ceil_to_10_minutes(dt: datetime) -> datetime:
-    m = ceil(dt.minute / 10) * 10
-    if m == 60:
-        return dt.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
-    return dt.replace(minute=m, second=0, microsecond=0)
+    for i in range(n_buckets):
+        bucket = first_bucket + i
+        if event_i < buckets.shape[0] and buckets[event_i] == bucket:
+            active_users += deltas[event_i]
+            event_i += 1
+        slot = bucket % 144
+        if counts[slot] == 0 or active_users > peaks[slot]:
+            peaks[slot] = active_users
+        sums[slot] += active_users
+        counts[slot] += 1
+    return sums, peaks, counts
 
 
 @app.get("/api/activity/graph", response_model=List[TimeSlotData])
@@ -227,7 +227,8 @@ async def get_activity_graph_data(
         None,
         description="Inclusive end of the sampling window (ISO 8601 format, e.g. 2024-03-10T23:59:59)",
         example="2024-03-10T23:59:59"),
-    auth=fastapi.Depends(require_auth)
+    auth=fastapi.Depends(require_auth),
+    db: AsyncSession = fastapi.Depends(get_db)
 ) -> List[TimeSlotData]:
     start_dt = None
     end_dt = None
@@ -246,119 +247,80 @@ async def get_activity_graph_data(
             logger.error(f"Invalid end date format: {end} - {e}")
             raise HTTPException(status_code=400, detail="Invalid end date format. Use ISO 8601 format.")
 
-    try:
-        # 1. Fetch all events + their channels\
-        db = next(get_db())
+    # Events are stored as naive local time and asyncpg can't bind aware datetimes to those columns
+    if start_dt and start_dt.tzinfo:
+        start_dt = start_dt.astimezone().replace(tzinfo=None)
+    if end_dt and end_dt.tzinfo:
+        end_dt = end_dt.astimezone().replace(tzinfo=None)
 
+    try:
+        # 1. Classify events as joins (+1) and leaves (-1) of non-AFK channels and sum them per 10-minute bucket
+        afk_ids = await get_afk_channel_ids(db)
+        prev_afk = func.coalesce(Event.prevChannel.in_(afk_ids), False)
+        next_afk = func.coalesce(Event.nextChannel.in_(afk_ids), False)
+        delta = case(
+            # OPEN: from None or AFK → non-AFK
+            (and_(or_(Event.prevChannel.is_(None), prev_afk), Event.nextChannel.is_not(None), not_(next_afk)), 1),
+            # CLOSE: from non-AFK → None or AFK
+            (and_(Event.prevChannel.is_not(None), not_(prev_afk), or_(Event.nextChannel.is_(None), next_afk)), -1),
+            # Ignore: non-AFK → non-AFK
+            else_=0
+        )
+        # Buckets are numbered from the epoch, so bucket % 144 is the 10-minute slot of the day
+        bucket = cast(func.floor(func.extract("epoch", Event.timestamp) / 600), BigInteger).label("bucket")
+
+        stmt = (
+            select(bucket, func.sum(delta))
+            .where(
+                Event.id > 3941,
+                delta != 0,
+                not_(and_(
+                    Event.user_.is_not(None),
+                    or_(Event.prevChannel.is_not_distinct_from(-1), Event.nextChannel.is_not_distinct_from(-1))
+                ))
+            )
+            .group_by("bucket")
+            .order_by("bucket")
+        )
+        if start_dt:
+            stmt = stmt.where(Event.timestamp >= start_dt)
+        if end_dt:
+            stmt = stmt.where(Event.timestamp <= end_dt)
+
+        # Stream the rows through a server-side cursor straight into arrays
+        bucket_parts = []
+        delta_parts = []
         try:
-            if start_dt and end_dt:
-            # noinspection PyTypeChecker
-                events: List[Event] = db.query(Event).where(Event.id>3941,
-                                                            Event.timestamp >= start_dt,
-                                                            Event.timestamp <= end_dt).all()
-            elif start_dt:
-            # noinspection PyTypeChecker
-                events: List[Event] = db.query(Event).where(Event.id>3941,
-                                                            Event.timestamp >= start_dt).all()
-            elif end_dt:
-            # noinspection PyTypeChecker
-                events: List[Event] = db.query(Event).where(Event.id>3941,
-                                                            Event.timestamp <= end_dt).all()
-            else:
-            # noinspection PyTypeChecker
-                events: List[Event] = db.query(Event).where(Event.id>3941).all()
+            rows = await db.stream(stmt.execution_options(yield_per=10000))
+            async for partition in rows.partitions():
+                bucket_parts.append(np.fromiter((row[0] for row in partition), dtype=np.int64, count=len(partition)))
+                delta_parts.append(np.fromiter((row[1] for row in partition), dtype=np.int64, count=len(partition)))
         except Exception as e:
-            rollback()
+            await db.rollback()
             e.add_note("Rolled back")
             raise e
 
-        if not events:
-            return []
-
-        # 2. Load all channels in memory for AFK lookup
-        channels = {ch.id: ch for ch in db.query(Channel).all()}
-
-        def is_afk(channel_id: int | None) -> bool:
-            if channel_id is None:
-                return False
-            ch = channels.get(channel_id)
-            return ch.is_afk if ch else False
-
-        # 3. Build "sweep line" event list: (timestamp, +1/-1)
-        line_events = []  # (timestamp, delta)
-
-        for e in events:
-            if e.user is not None and (e.prevChannel == -1 or e.nextChannel == -1):
-                continue
-
-            prev = e.prevChannel
-            nxt = e.nextChannel
-
-            prev_afk = is_afk(prev)
-            next_afk = is_afk(nxt)
-
-            # OPEN: from None or AFK → non-AFK
-            if (prev is None or prev_afk) and (nxt is not None and not next_afk):
-                line_events.append((e.timestamp, +1))
-                continue
-
-            # CLOSE: from non-AFK → None or AFK
-            if (prev is not None and not prev_afk) and (nxt is None or next_afk):
-                line_events.append((e.timestamp, -1))
-                continue
-
-            # Ignore: non-AFK → non-AFK
-            # Do nothing
-
-        if not line_events:
+        if not bucket_parts:
             return []
 
-        # 4. Sort all sweep events
-        line_events.sort(key=lambda x: x[0])
-
-        # 5. Determine the time span for buckets
-        start_time = floor_to_10_minutes(line_events[0][0])
-        end_time = ceil_to_10_minutes(line_events[-1][0])
-
-        def datetime_to_bucket(dt):
-            return (dt.hour * 60 + dt.minute) // 10
-
-        # 7. Sweep through events while iterating buckets
-        result: List[TimeSlotData] = []
-        active_users = 0
-        num_events = len(line_events)
-        final_buckets = [[] for _ in range(144)]
-        bucket_start = start_time
-        bucket_end = bucket_start + datetime.timedelta(minutes=10)
-        event_i = 0
-
-        while bucket_end <= end_time:
-            while event_i < num_events and line_events[event_i][0] <= bucket_end:
-                _, delta = line_events[event_i]
-                active_users += delta
-                event_i += 1
-
-            final_buckets[datetime_to_bucket(bucket_start)].append(active_users)
-            bucket_start += timedelta(minutes=10)
-            bucket_end += timedelta(minutes=10)
-        for i in range(144):
-            result.append(
-                TimeSlotData(
-                    time=f"{i//6:02d}:{(i%6)*10:02d}",
-                    hour=i % 24,
-                    minute=(i % 6) * 10,
-                    averageUsers=sum(final_buckets[i])/len(final_buckets[i]),
-                    peakUsers=max(final_buckets[i])
-                ) if len(final_buckets[i]) > 0  else
-                TimeSlotData(
-                    time=f"{i//6:02d}:{(i%6)*10:02d}",
-                    hour=i % 24,
-                    minute=(i % 6) * 10,
-                    averageUsers=0,
-                    peakUsers=0
-                )
+        # 2. Sweep through every bucket between the first and the last event, including empty ones
+        buckets = np.concatenate(bucket_parts)
+        deltas = np.concatenate(delta_parts)
+        first_bucket = int(buckets[0])
+        sums, peaks, counts = sweep(buckets, deltas, first_bucket, int(buckets[-1]) - first_bucket + 1)
+
+        # 3. Average over the sampled days, slots without samples stay at 0 (peaks are 0 there already)
+        averages = np.divide(sums, counts, out=np.zeros(144), where=counts > 0)
+        return [
+            TimeSlotData(
+                time=time,
+                hour=hour,
+                minute=minute,
+                averageUsers=float(averages[i]),
+                peakUsers=int(peaks[i])
             )
-        return result
+            for i, (time, hour, minute) in enumerate(BUCKET_META)
+        ]
     except Exception:
         logger.exception("Unhandled error")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -371,6 +333,10 @@ async def health_check():
     logger.info("healthy")
     return {"status": "healthy"}
 
+@app.get("/api/active")
+async def active(auth=fastapi.Depends(require_auth)):
+    return {"activeUsers": int(await redis_client.get(ACTIVE_USERS_KEY) or 0)}
+
 @app.get("/api/logs")
 async def logs(auth=fastapi.Depends(require_auth)):
     try:
@@ -389,9 +355,13 @@ async def logs(auth=fastapi.Depends(require_auth)):
 async def login(request: Request):
     data = await request.json()
     password = data.get("password")
-    if hashlib.md5(password.encode()).hexdigest() == getenv("MD5_PASSWORD"):
+    # Hashing takes a noticeable fraction of a second, keep it off the event loop
+    if password and hmac.compare_digest(
+        await asyncio.to_thread(hashlib.pbkdf2_hmac, "sha256", password.encode(), PASSWORD_SALT, PBKDF2_ITERATIONS),
+        PASSWORD_HASH
+    ):
         token = secrets.token_hex(32)
-        active_tokens.add(token)
+        await redis_client.setex(f"tok:{token}", TOKEN_TTL, "1")
         return {"token": token}
     else:
         raise HTTPException(401, "wrong password")
@@ -1,34 +1,69 @@
-from api import logger
+import logging
 from models import *
-from sqlalchemy import create_engine, func, and_, desc, select
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, func, and_, desc, select, make_url
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 import os
+import redis.asyncio as redis
 from dotenv import load_dotenv
-import inspect
+import sys
+import time
 load_dotenv()
 
-engine = create_engine(os.getenv("DATABASE_URL"))
+logger = logging.getLogger("app")
+
+engine = create_engine(
+    os.getenv("DATABASE_URL"),
+    pool_size=20,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=3600
+)
 Base.metadata.create_all(engine)
+# create_all skips tables that already exist, so indexes added later are created separately
+for index in Event.__table__.indexes:
+    index.create(engine, checkfirst=True)
 s = sessionmaker(engine)
-session: Session | None = s()
+# Thread-local session for the bot handlers and the atexit hook
+session: scoped_session[Session] = scoped_session(s)
 
+# Async engine for the API, so queries don't block the event loop shared with the bot
+async_engine = create_async_engine(
+    make_url(os.getenv("DATABASE_URL")).set(drivername="postgresql+asyncpg"),
+    pool_size=20,
+    max_overflow=10,
+    pool_recycle=3600
+)
+SessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession)
 
-def get_user(user_handle: str) -> User | None:
-    global session
-    return session.query(User).filter_by(handle=user_handle).first()
+redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
+# Number of users in non-AFK voice channels, kept up to date by the bot
+ACTIVE_USERS_KEY = "active_users"
 
-def get_channel(channel_id: int) -> Channel | None:
-    global session
-    return session.query(Channel).filter_by(id=channel_id).first()
+
+# Ids of AFK channels, shared by the bot and the API since they run in one process
+afk_channels_cache: frozenset[int] = frozenset()
+cache_ts: float = 0
+CHANNELS_CACHE_TTL = 300
+
+async def get_afk_channel_ids(db: AsyncSession) -> frozenset[int]:
+    global afk_channels_cache, cache_ts
+    if time.time() - cache_ts >= CHANNELS_CACHE_TTL:
+        afk_channels_cache = frozenset((await db.scalars(select(Channel.id).where(Channel.is_afk))).all())
+        cache_ts = time.time()
+    return afk_channels_cache
+
+def invalidate_channels_cache() -> None:
+    global cache_ts
+    cache_ts = 0
 
 def add(obj: Base) -> None:
     global session
-    # stack = inspect.stack()
-    # caller_frame = stack[1]
-    # filename = caller_frame.filename
-    # line_number = caller_frame.lineno
-    # function_name = caller_frame.function
-    # print(f"Creation of a {obj.__repr__()} object at {filename} line {line_number} function {function_name}")
+    if logger.isEnabledFor(logging.DEBUG):
+        caller_frame = sys._getframe(1)
+        logger.debug(f"Creation of a {obj.__repr__()} object at {caller_frame.f_code.co_filename} "
+                     f"line {caller_frame.f_lineno} function {caller_frame.f_code.co_name}")
     try:
         session.add(obj)
         session.commit()
@@ -36,6 +71,25 @@ def add(obj: Base) -> None:
         rollback()
         logger.exception("Unhandled exception")
 
+def bulk_insert(model: type[Base], rows: list[dict], update_columns: tuple[str, ...] = ()) -> None:
+    """Insert all rows in one statement, rows that already exist are skipped or get update_columns overwritten"""
+    global session
+    if not rows:
+        return
+    table = model.__table__
+    stmt = insert(table).values(rows)
+    if update_columns:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(table.primary_key),
+            set_={column: stmt.excluded[column] for column in update_columns}
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+    session.execute(stmt)
+
+def commit() -> None:
+    session.commit()
+
 def rollback() -> None:
     session.rollback()
 
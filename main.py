@@ -50,34 +50,94 @@ intents.voice_states = True
 intents.members = True
 client = discord.Client(intents=intents)
 TOKEN_DISCORD = os.getenv("TOKEN_DISCORD")
-active_users = 0
+FLUSH_INTERVAL = 0.2
+# Voice state changes waiting to be written by flush_loop: (new channels, user, alias, event)
+event_queue: asyncio.Queue[tuple[list[dict], dict, dict, dict]] = asyncio.Queue()
+known_channels: set[int] = set()
+
+
+def channel_row(channel: discord.abc.GuildChannel) -> dict:
+    channel_db = Channel(channel)
+    return {"id": channel_db.id, "name": channel_db.name, "is_afk": channel_db.is_afk, "type": channel_db.type}
+
+
+def user_row(member: Member) -> dict:
+    return {"handle": member.name, "pfp": member.avatar.url, "is_bot": member.bot}
+
+
+def flush_events() -> None:
+    """Write every queued voice state change in one transaction"""
+    channels: dict[int, dict] = {}
+    users: dict[str, dict] = {}
+    aliases: set[tuple[str, str]] = set()
+    events: list[dict] = []
+    while not event_queue.empty():
+        channel_rows, user, alias, event = event_queue.get_nowait()
+        channels.update((row["id"], row) for row in channel_rows)
+        users[user["handle"]] = user
+        aliases.add((alias["name"], alias["handle"]))
+        events.append(event)
+    if not events:
+        return
+    try:
+        bulk_insert(Channel, list(channels.values()))
+        bulk_insert(User, list(users.values()), update_columns=("pfp",))
+        bulk_insert(Alias, [{"name": name, "handle": handle} for name, handle in aliases])
+        bulk_insert(Event, events)
+        commit()
+    except Exception:
+        rollback()
+        logging.exception("Unhandled exception")
+        return
+    # Only committed channels count as known, otherwise later events would reference a missing row
+    if channels:
+        known_channels.update(channels)
+        invalidate_channels_cache()
+
+
+async def flush_loop():
+    while True:
+        await sleep(FLUSH_INTERVAL)
+        flush_events()
+
 
 @client.event
 async def on_ready():
-    global active_users
     await client.change_presence(status=discord.Status.invisible)
     active_users = 0
     logging.info(f'✅ Бот запущен как {client.user}')
+    # Collect everything first and write it with one INSERT per table
+    channels_to_add: list[dict] = []
+    users_to_add: dict[str, dict] = {}
+    aliases_to_add: set[tuple[str, str]] = set()
+    events_to_add: list[dict] = []
     for guild in client.guilds:
         for channel in guild.channels:
-            channel_db = get_channel(channel.id)
-            if not channel_db:
-                channel_db = Channel(channel)
-                add(channel_db)
+            channels_to_add.append(channel_row(channel))
             if type(channel) is discord.VoiceChannel:
                 for member in channel.members:
                     if not member.bot and channel != guild.afk_channel:
                         active_users += 1
-                    user = get_user(member.name)
-                    if not user:
-                        user = User(member)
-                        add(user)
-                    if not user.aliases or member.display_name not in user.aliases:
-                        add(Alias(user, member.display_name))
-                    if not user.pfp == member.avatar.url:
-                        user.pfp = member.avatar.url
-                    join = Event(None, channel_db, user)
-                    add(join)
+                    users_to_add[member.name] = user_row(member)
+                    aliases_to_add.add((member.display_name, member.name))
+                    events_to_add.append({
+                        "prevChannel": None,
+                        "nextChannel": channel.id,
+                        "user": member.name,
+                        "timestamp": dt.now()
+                    })
+    try:
+        bulk_insert(Channel, channels_to_add)
+        bulk_insert(User, list(users_to_add.values()), update_columns=("pfp",))
+        bulk_insert(Alias, [{"name": name, "handle": handle} for name, handle in aliases_to_add])
+        bulk_insert(Event, events_to_add)
+        commit()
+        known_channels.update(row["id"] for row in channels_to_add)
+    except Exception:
+        rollback()
+        logging.exception("Unhandled exception")
+    invalidate_channels_cache()
+    await redis_client.set(ACTIVE_USERS_KEY, active_users)
     logging.info(f"👶 Активно {active_users} пользователей")
 
 
@@ -85,41 +145,42 @@ async def on_ready():
 async def on_voice_state_update(member: Member, before: VoiceState, after: VoiceState):
     if before.channel == after.channel:
         return
-    global active_users
-    previous_channel: Channel | None = None
-    if before.channel:
-        previous_channel = get_channel(before.channel.id)
-        if not previous_channel:
-            previous_channel = Channel(before.channel)
-            add(previous_channel)
-    next_channel: Channel | None = None
-    if after.channel:
-        next_channel = get_channel(after.channel.id)
-        if not next_channel:
-            next_channel = Channel(after.channel)
-    user: User | None = get_user(member.name)
-    if not user:
-        user = User(member)
-        add(user)
-    if not user.aliases or member.display_name not in user.aliases:
-        add(Alias(user, member.display_name))
-    if not user.pfp == member.avatar.url:
-        user.pfp = member.avatar.url
-    add(Event(previous_channel, next_channel, user))
+    # Written in batches by flush_loop, the timestamp is taken now so batching doesn't shift it
+    new_channels = []
+    for channel in (before.channel, after.channel):
+        if channel and channel.id not in known_channels:
+            new_channels.append(channel_row(channel))
+    event_queue.put_nowait((
+        new_channels,
+        user_row(member),
+        {"name": member.display_name, "handle": member.name},
+        {
+            "prevChannel": before.channel.id if before.channel else None,
+            "nextChannel": after.channel.id if after.channel else None,
+            "user": member.name,
+            "timestamp": dt.now()
+        }
+    ))
     if member.bot:
         return
-    if next_channel and (not previous_channel or previous_channel.is_afk) and not next_channel.is_afk:
-        if not member.bot:
-            active_users += 1
-    elif not after.channel or (before.channel and after.channel == after.channel.guild.afk_channel) and before.channel != before.channel.guild.afk_channel:
-        if not member.bot:
-            active_users -= 1
-            active_users = max(0, active_users)
+    # Same open/close rule as the activity graph: only entering or leaving a non-AFK channel counts
+    was_active = before.channel is not None and before.channel != before.channel.guild.afk_channel
+    is_active = after.channel is not None and after.channel != after.channel.guild.afk_channel
+    if is_active and not was_active:
+        active_users = await redis_client.incr(ACTIVE_USERS_KEY)
+    elif was_active and not is_active:
+        active_users = await redis_client.decr(ACTIVE_USERS_KEY)
+        if active_users < 0:
+            active_users = 0
+            await redis_client.set(ACTIVE_USERS_KEY, 0)
+    else:
+        return
     logging.info(f"👶 Активно {active_users} пользователей")
 
 
 @atexit.register
 def close_all_sessions() -> None:
+    flush_events()
     unclosed_users: list[User] = get_active_users()
     for user in unclosed_users:
         add(Event(user.latest_event.next_channel, None, user))
@@ -142,7 +203,8 @@ async def start_uvicorn():
 async def main():
     await asyncio.gather(
         client.start(TOKEN_DISCORD),
-        start_uvicorn()
+        start_uvicorn(),
+        flush_loop()
     )
 
 if __name__ == "__main__":
@@ -2,8 +2,8 @@ from typing import List, Optional
 
 from discord import ChannelType, Member
 from sqlalchemy import Boolean, Column, DateTime, ForeignKeyConstraint, Integer, PrimaryKeyConstraint, String, Table, \
-    text, Enum, BigInteger, ForeignKey
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+    text, Enum, BigInteger, ForeignKey, Index, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, object_session
 import datetime
 import discord
 
@@ -84,7 +84,8 @@ class User(Base):
     is_bot: Mapped[Optional[bool]] = mapped_column(Boolean)
 
     events: Mapped[List['Event']] = relationship('Event', back_populates='user')
-    aliases: Mapped[List['Alias']] = relationship('Alias', back_populates='user')
+    # Loaded with one IN query per batch of users, lazy loading is not available under AsyncSession
+    aliases: Mapped[List['Alias']] = relationship('Alias', back_populates='user', lazy='selectin')
 
     def __init__(self, user: Member, **kwargs):
         super().__init__(**kwargs)
@@ -93,8 +94,11 @@ class User(Base):
         self.is_bot = user.bot
 
     @property
-    def latest_event(self) -> 'Event':
-        return max(self.events, key=lambda e: e.timestamp, default=None)
+    def latest_event(self) -> Optional['Event']:
+        """Fetches only the newest event instead of loading all of them"""
+        return object_session(self).scalars(
+            select(Event).where(Event.user_ == self.handle).order_by(Event.timestamp.desc()).limit(1)
+        ).first()
 
     def __repr__(self):
         return f"(User){self.handle}: bot-{self.is_bot} {self.pfp}"
@@ -130,4 +134,11 @@ class Event(Base):
         self.user = user
 
     def __repr__(self) -> str:
-        return f"(Event){self.user_}: {getattr(self.previous_channel, 'name', None)} -> {getattr(self.next_channel, 'name', None)} at {self.timestamp}"
\ No newline at end of file
+        return f"(Event){self.user_}: {getattr(self.previous_channel, 'name', None)} -> {getattr(self.next_channel, 'name', None)} at {self.timestamp}"
+
+
+# Indexes for the columns the API filters, groups and joins on
+Index("ix_event_user_timestamp", Event.user_, Event.timestamp.desc())
+Index("ix_event_timestamp", Event.timestamp)
+Index("ix_event_prevchannel", Event.prevChannel)
+Index("ix_event_nextchannel", Event.nextChannel)